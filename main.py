@@ -1,24 +1,37 @@
+import asyncio
+import hmac
 import json
 import os
 import time
-import uuid
+from contextlib import asynccontextmanager
 from typing import (
     Any,
     Dict,
+    FrozenSet,
     List,
     Optional,
     AsyncGenerator,
     Union,
 )  # <--- 1. 导入 Union
 
+import anyio
 import httpx
-from fastapi import FastAPI, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+import msgspec
+import orjson
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
 
+from normalize import build_history
 
-class ChatMessage(BaseModel):
+
+# Request bodies are decoded with msgspec instead of Pydantic: decoding and validation
+# happen in one C pass, and unknown fields (max_tokens, top_p, ...) are ignored.
+# Structs are slotted already; they are never mutated or part of reference cycles,
+# so they are also frozen and left untracked by the garbage collector.
+class ChatMessage(msgspec.Struct, frozen=True, gc=False):
     role: str
     # --- MODIFICATION START ---
     # 2. 允许 content 字段是字符串或一个包含字典的列表
@@ -27,7 +40,7 @@ class ChatMessage(BaseModel):
     # --- MODIFICATION END ---
 
 
-class ChatCompletionRequest(BaseModel):
+class ChatCompletionRequest(msgspec.Struct, frozen=True, gc=False):
     model: str
     messages: List[ChatMessage]
     stream: bool = False
@@ -62,7 +75,7 @@ class ChatCompletionChoice(BaseModel):
 
 
 class ChatCompletionResponse(BaseModel):
-    id: str = Field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex}")
+    id: str = Field(default_factory=lambda: f"chatcmpl-{os.urandom(16).hex()}")
     object: str = "chat.completion"
     created: int = Field(default_factory=lambda: int(time.time()))
     model: str
@@ -76,26 +89,11 @@ class ChatCompletionResponse(BaseModel):
     )
 
 
-class StreamChoice(BaseModel):
-    delta: Dict[str, Any] = Field(default_factory=dict)
-    index: int = 0
-    finish_reason: Optional[str] = None
-
-
-class StreamResponse(BaseModel):
-    id: str = Field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex}")
-    object: str = "chat.completion.chunk"
-    created: int = Field(default_factory=lambda: int(time.time()))
-    model: str
-    choices: List[StreamChoice]
-
-
 # ... [以上部分代码无需修改，保持原样] ...
 
 
-app = FastAPI(title="TalkAI OpenAI API Adapter")
 security = HTTPBearer()
-VALID_CLIENT_KEYS: set = set()
+VALID_CLIENT_KEYS: FrozenSet[bytes] = frozenset()
 TALKAI_API_KEY: Optional[str] = None
 
 
@@ -106,11 +104,17 @@ def load_client_api_keys():
     # This is loaded from an environment variable for security in deployment
     service_keys_str = os.environ.get("PASSWORD")
     if service_keys_str:
-        VALID_CLIENT_KEYS = set(key.strip() for key in service_keys_str.split(','))
-        print(f"Loaded {len(VALID_CLIENT_KEYS)} service auth key(s) from environment variable (PASSWORD).")
+        # Stored as bytes so authenticate_client can compare them with hmac.compare_digest
+        VALID_CLIENT_KEYS = frozenset(
+            key.strip().encode() for key in service_keys_str.split(',') if key.strip()
+        )
+        if VALID_CLIENT_KEYS:
+            print(f"Loaded {len(VALID_CLIENT_KEYS)} service auth key(s) from environment variable (PASSWORD).")
+        else:
+            print("Environment variable (PASSWORD) is set but contains no keys. Service authentication may be open.")
     else:
         # Fallback for local testing if env var is not set
-        VALID_CLIENT_KEYS = set()
+        VALID_CLIENT_KEYS = frozenset()
         print("No service auth keys loaded from environment variable (PASSWORD). Service authentication may be open.")
 
     # Load the API key for authenticating with the downstream TalkAI service
@@ -131,108 +135,214 @@ def load_client_api_keys():
 async def authenticate_client(
     auth: Optional[HTTPAuthorizationCredentials] = Depends(security),
 ):
-    if VALID_CLIENT_KEYS and (not auth or auth.credentials not in VALID_CLIENT_KEYS):
+    if not VALID_CLIENT_KEYS:
+        return
+    credentials = auth.credentials.encode() if auth else b""
+    # Constant-time comparison so response timing does not leak how much of a key matched
+    if not any(hmac.compare_digest(credentials, key) for key in VALID_CLIENT_KEYS):
         raise HTTPException(status_code=401, detail="Invalid API key")
 
 
-@app.on_event("startup")
-async def startup():
-    load_client_api_keys()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # File reads happen here, in a worker thread, so no request handler ever blocks on disk I/O
+    await anyio.to_thread.run_sync(load_client_api_keys)
+    app.state.models_json = await anyio.to_thread.run_sync(load_models_json)
+    # One pooled client for the whole process so upstream connections are reused across requests
+    app.state.http = httpx.AsyncClient(
+        timeout=httpx.Timeout(300.0, connect=10.0),
+        http2=True,
+        limits=httpx.Limits(max_connections=1000, max_keepalive_connections=200),
+    )
+    yield
+    await app.state.http.aclose()
+
+
+app = FastAPI(title="TalkAI OpenAI API Adapter", lifespan=lifespan)
 
 
-def get_models_list() -> ModelList:
+def load_models_json() -> bytes:
+    """Read models.json once and return the serialized /v1/models response body."""
     try:
-        with open("models.json", "r", encoding="utf-8") as f:
-            models_dict = json.load(f)
-        return ModelList(
-            data=[ModelInfo(id=model_id) for model_id in models_dict.values()]
-        )
-    except:
-        return ModelList(data=[])
+        with open("models.json", "rb") as f:
+            models_dict = orjson.loads(f.read())
+        model_ids = list(models_dict.values())
+    except Exception:
+        model_ids = []
+    created = int(time.time())
+    return orjson.dumps(
+        {
+            "object": "list",
+            "data": [
+                {"id": model_id, "object": "model", "created": created, "owned_by": "talkai"}
+                for model_id in model_ids
+            ],
+        }
+    )
 
 
-@app.get("/v1/models", response_model=ModelList)
+@app.get("/v1/models", response_class=Response, responses={200: {"model": ModelList}})
 async def list_models(
     auth: Optional[HTTPAuthorizationCredentials] = Depends(authenticate_client),
 ):
-    return get_models_list()
+    return Response(app.state.models_json, media_type="application/json")
+
+
+# Byte constants for the upstream SSE format: "data:" lines, "-1" payloads to skip, escaped newlines
+_PREFIX = b"data:"
+_SKIP = b"-1"
+_ESC = b"\\n"
+_NL = b"\n"
+
+
+def _data_payloads(lines: List[bytes]) -> List[bytes]:
+    payloads = []
+    for line in lines:
+        if line.startswith(_PREFIX):
+            payload = line[5:].strip()
+            if payload and payload != _SKIP:
+                payloads.append(payload)
+    return payloads
+
+
+async def iter_sse_data(response: httpx.Response) -> AsyncGenerator[List[bytes], None]:
+    """Yield the non-empty `data:` payloads of the upstream SSE stream, one list per network chunk.
+
+    Works on raw bytes so lines are never decoded individually; a partial line is carried
+    over to the next chunk.
+    """
+    buf = b""
+    # No chunk_size: httpx would otherwise hold data back until that many bytes arrived
+    async for chunk in response.aiter_bytes():
+        lines = (buf + chunk).split(_NL)
+        buf = lines.pop()
+        payloads = _data_payloads(lines)
+        if payloads:
+            yield payloads
+    if buf:
+        payloads = _data_payloads([buf])
+        if payloads:
+            yield payloads
+
+
+# SSE frames are pre-serialized; per stream only the id, timestamp and model (and per chunk
+# the content) are substituted with a single C-level bytes format
+_ROLE_HEAD = (
+    b'data: {"id":"%b","object":"chat.completion.chunk","created":%d,"model":%b,'
+    b'"choices":[{"delta":{"role":"assistant"},"index":0,"finish_reason":null}]}\n\n'
+)
+_CONTENT_FRAME = (
+    b'data: {"id":"%b","object":"chat.completion.chunk","created":%d,"model":%b,'
+    b'"choices":[{"delta":{"content":%b},"index":0,"finish_reason":null}]}\n\n'
+)
+_STOP = (
+    b'data: {"id":"%b","object":"chat.completion.chunk","created":%d,"model":%b,'
+    b'"choices":[{"delta":{},"index":0,"finish_reason":"stop"}]}\n\n'
+)
+_DONE = b"data: [DONE]\n\n"
 
 
 async def stream_generator(
     response: httpx.Response, model: str
-) -> AsyncGenerator[str, None]:
-    stream_id = f"chatcmpl-{uuid.uuid4().hex}"
+) -> AsyncGenerator[bytes, None]:
+    stream_id_bytes = f"chatcmpl-{os.urandom(16).hex()}".encode()
     created_time = int(time.time())
+    model_bytes = orjson.dumps(model)
+
+    # Upstream reads and client writes run decoupled; the bounded queue applies backpressure
+    # to the reader when the client falls behind instead of buffering without limit
+    queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+
+    async def produce() -> None:
+        try:
+            # Tokens that arrived in the same upstream chunk are flushed to the client as one write
+            async for payloads in iter_sse_data(response):
+                await queue.put(
+                    b"".join(
+                        [
+                            _CONTENT_FRAME
+                            % (
+                                stream_id_bytes,
+                                created_time,
+                                model_bytes,
+                                orjson.dumps(payload.replace(_ESC, _NL).decode("utf-8", "replace")),
+                            )
+                            for payload in payloads
+                        ]
+                    )
+                )
+        except Exception as e:
+            # Handed to the consumer, which re-raises it in the task serving the response
+            await queue.put(e)
+        else:
+            await queue.put(None)
 
-    yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'role': 'assistant'})]).json()}\n\n"
+    # A plain task rather than a TaskGroup: the consumer pauses at every yield, and a task
+    # group held open across it would cancel or fail whichever task happens to run the response
+    producer = asyncio.create_task(produce())
+    try:
+        yield _ROLE_HEAD % (stream_id_bytes, created_time, model_bytes)
 
-    async for line in response.aiter_lines():
-        if line.startswith("data:"):
-            content = line[5:].strip()
-            normalized_content = content.replace("\\n", "\n")
-            if normalized_content and normalized_content != "-1":
-                yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'content': normalized_content})]).json()}\n\n"
+        while (frames := await queue.get()) is not None:
+            if isinstance(frames, Exception):
+                raise frames
+            yield frames
 
-    yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={}, finish_reason='stop')]).json()}\n\n"
-    yield "data: [DONE]\n\n"
+        yield _STOP % (stream_id_bytes, created_time, model_bytes) + _DONE
+    finally:
+        producer.cancel()
+        await asyncio.wait((producer,))
+        # Backstop for the response's background task: hand the connection back to the pool
+        await response.aclose()
 
 
-async def aggregate_stream(response: httpx.Response) -> str:
-    content = []
-    async for line in response.aiter_lines():
-        if line.startswith("data:"):
-            data = line[5:].strip()
-            if data and data != "-1":
-                content.append(data)
-    return "".join(content).replace("\\n", "\n")
+async def close_stream(
+    stream: AsyncGenerator[bytes, None], response: httpx.Response
+) -> None:
+    # Stops the generator's upstream reader task, then closes the upstream response
+    # directly, since the generator's own cleanup never runs if it was not started
+    await stream.aclose()
+    await response.aclose()
 
 
-@app.post("/v1/chat/completions")
+async def aggregate_stream(response: httpx.Response) -> str:
+    content = bytearray()
+    async for payloads in iter_sse_data(response):
+        for payload in payloads:
+            content += payload
+    # Unescape and decode once over the whole body rather than per payload
+    return content.replace(_ESC, _NL).decode("utf-8", "replace")
+
+
+# Both branches return a Response subclass themselves (ORJSONResponse or StreamingResponse),
+# so FastAPI never re-encodes the result; the Pydantic model below only documents the schema.
+@app.post(
+    "/v1/chat/completions",
+    response_class=Response,
+    responses={200: {"model": ChatCompletionResponse}},
+)
 async def chat_completions(
-    request: ChatCompletionRequest,
+    http_request: Request,
     auth: Optional[HTTPAuthorizationCredentials] = Depends(authenticate_client),
 ):
+    try:
+        # strict=False keeps Pydantic's lax coercion, e.g. "stream": "true"
+        request = msgspec.json.decode(
+            await http_request.body(), type=ChatCompletionRequest, strict=False
+        )
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
     if not request.messages:
         raise HTTPException(status_code=400, detail="Messages required")
 
-    messages_history = []
-    system_prompt = ""
-
-    for msg in request.messages:
-        # --- MODIFICATION START ---
-        # 3. 处理可能为列表的 content 字段
-        current_content = ""
-        if isinstance(msg.content, str):
-            current_content = msg.content
-        elif isinstance(msg.content, list):
-            # 如果 content 是一个列表，遍历它并拼接所有 "text" 类型的内容
-            for part in msg.content:
-                if isinstance(part, dict) and part.get("type") == "text":
-                    current_content += part.get("text", "")
-        # --- MODIFICATION END ---
-
-        if msg.role == "system":
-            system_prompt = current_content
-        elif msg.role in ["user", "assistant"]:
-            messages_history.append(
-                {
-                    "id": str(uuid.uuid4()),
-                    "from": "you" if msg.role == "user" else "assistant",
-                    "content": current_content,  # 使用处理过后的 current_content
-                }
-            )
-
-    if system_prompt and messages_history and messages_history[-1]["from"] == "you":
-        messages_history[-1][
-            "content"
-        ] = f"{system_prompt}\n\n{messages_history[-1]['content']}"
+    messages_history = build_history(request.messages)
 
     payload = {
         "type": "chat",
         "messagesHistory": messages_history,
         "settings": {"model": request.model, "temperature": request.temperature},
     }
-    print(payload)
 
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
@@ -244,31 +354,58 @@ async def chat_completions(
         headers['Authorization'] = f"Bearer {TALKAI_API_KEY}"
 
     try:
-        client = httpx.AsyncClient(timeout=300)
+        client: httpx.AsyncClient = app.state.http
         req = client.build_request(
             "POST",
             "https://claude.talkai.info/chat/send/",
-            json=payload,
+            content=orjson.dumps(payload),
             headers=headers,
         )
         response = await client.send(req, stream=True)
+        if response.is_error:
+            await response.aclose()
         response.raise_for_status()
 
         if request.stream:
+            stream = stream_generator(response, request.model)
             return StreamingResponse(
-                stream_generator(response, request.model),
+                stream,
+                media_type="text/event-stream",
+                headers={
+                    # Keep nginx and similar reverse proxies from buffering the token stream
+                    "X-Accel-Buffering": "no",
+                    "Cache-Control": "no-cache",
+                    "Connection": "keep-alive",
+                },
                 status_code=response.status_code,
+                # Starlette never closes body_iterator on disconnect, but always runs the background task
+                background=BackgroundTask(close_stream, stream, response),
             )
         else:
-            content = await aggregate_stream(response)
-            return ChatCompletionResponse(
-                model=request.model,
-                # 确保返回的 message 格式正确
-                choices=[
-                    ChatCompletionChoice(
-                        message=ResponseMessage(role="assistant", content=content)
-                    )
-                ],
+            try:
+                content = await aggregate_stream(response)
+            finally:
+                await response.aclose()
+            # Same shape as ChatCompletionResponse, built directly to skip model validation
+            return ORJSONResponse(
+                {
+                    "id": f"chatcmpl-{os.urandom(16).hex()}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.model,
+                    "choices": [
+                        {
+                            "message": {"role": "assistant", "content": content},
+                            "index": 0,
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 0,
+                        "completion_tokens": 0,
+                        "total_tokens": 0,
+                    },
+                }
             )
 
     except httpx.HTTPStatusError as e:
@@ -311,7 +448,17 @@ if __name__ == "__main__":
 
     if not os.path.exists("client_api_keys.json"):
         with open("client_api_keys.json", "w", encoding="utf-8") as f:
-            json.dump([f"sk-talkai-{uuid.uuid4().hex}"], f)
+            json.dump([f"sk-talkai-{os.urandom(16).hex()}"], f)
 
     # 注意：您的原始代码中端口是 8001，我保持一致
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    # loop/http "auto" pick uvloop and httptools when uvicorn[standard] is installed (not available on Windows)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8001,
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        log_level="warning",
+        access_log=False,
+    )
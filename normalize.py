@@ -0,0 +1,61 @@
+from os import urandom
+from typing import Dict, List
+
+
+def build_history(messages) -> List[Dict[str, str]]:
+    """Flatten OpenAI-style messages into TalkAI's messagesHistory.
+
+    The system prompt is prepended to the final message when that message is from the user.
+
+    Kept free of FastAPI/Pydantic imports so `setup.py` can compile it with Cython;
+    the compiled extension takes precedence over this file when it has been built.
+    """
+    messages_history = []
+    append = messages_history.append
+    system_prompt = ""
+    last_user = None
+    # Ids only need to be unique within one request: a random base plus the message index
+    id_base = urandom(8).hex()
+
+    for msg in messages:
+        role = msg.role
+        content = msg.content
+
+        # content 可能是字符串，也可能是包含多个部分的列表（如 Claude Code 发送的格式）
+        current_content = ""
+        if isinstance(content, str):
+            current_content = content
+        elif isinstance(content, list):
+            # 如果 content 是一个列表，拼接所有 "text" 类型的内容（一次 join，避免逐段 += 的重复拷贝）
+            current_content = "".join(
+                [
+                    part.get("text", "")
+                    for part in content
+                    if isinstance(part, dict) and part.get("type") == "text"
+                ]
+            )
+
+        if role == "system":
+            system_prompt = current_content
+        elif role == "user":
+            last_user = {
+                "id": f"{id_base}{len(messages_history):x}",
+                "from": "you",
+                "content": current_content,
+            }
+            append(last_user)
+        elif role == "assistant":
+            # Only a trailing user message receives the system prompt
+            last_user = None
+            append(
+                {
+                    "id": f"{id_base}{len(messages_history):x}",
+                    "from": "assistant",
+                    "content": current_content,
+                }
+            )
+
+    if system_prompt and last_user is not None:
+        last_user["content"] = system_prompt + "\n\n" + last_user["content"]
+
+    return messages_history
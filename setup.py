@@ -0,0 +1,10 @@
+# Optional: compile normalize.py with Cython for a faster message-normalization loop.
+#   pip install cython && python setup.py build_ext --inplace
+# Without the compiled extension, main.py imports the pure-Python normalize.py unchanged.
+from Cython.Build import cythonize
+from setuptools import setup
+
+setup(
+    name="talkai-adapter-normalize",
+    ext_modules=cythonize(["normalize.py"], compiler_directives={"language_level": 3}),
+)